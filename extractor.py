@@ -1,20 +1,31 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Request, UploadFile, File, Form, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 
-from spire.presentation import *
+from spire.presentation import Presentation, IAutoShape, IChart, SlidePicture
 
 import os
-import json
+import orjson
+import hashlib
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image
 import cloudinary
 import cloudinary.uploader
+import cloudinary.utils
 from dotenv import load_dotenv
 import tempfile
-import shutil
+import time
+import aiofiles.tempfile
+import io
+import functools
 
 # --- Load Environment Variables ---
 load_dotenv()
 
 # --- Cloudinary Configuration ---
+CLOUDINARY_CONFIGURED = False
 try:
     cloudinary.config(
       cloud_name = os.getenv("CLOUD_NAME"),
@@ -24,16 +35,360 @@ try:
     )
     if not all([os.getenv("CLOUD_NAME"), os.getenv("API_KEY"), os.getenv("API_SECRET")]):
         raise ValueError("Cloudinary credentials not fully configured in .env")
+    CLOUDINARY_CONFIGURED = True
 except Exception as e:
     print(f"Error loading Cloudinary configuration: {e}")
 
+# --- Accepted Uploads ---
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 100 * 1024 * 1024))
+# .pptx files are ZIP containers; legacy .ppt files are OLE compound documents.
+PRESENTATION_SIGNATURES = (b"PK\x03\x04", b"\xd0\xcf\x11\xe0")
+
+# --- Upload Concurrency ---
+# Cloudinary rate-limits concurrent uploads per account, so cap the number of
+# in-flight requests even though every image of a deck is dispatched at once.
+UPLOAD_CONCURRENCY = 8
+_upload_slots = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+
+# The uploader's default connection pool keeps a single connection per host,
+# so concurrent uploads would each pay for a fresh TLS handshake. Size it to
+# the upload concurrency so connections are kept alive and reused.
+cloudinary.uploader._http = cloudinary.utils.get_http_connector(
+    cloudinary.config(), dict(cloudinary.CERT_KWARGS, maxsize=UPLOAD_CONCURRENCY)
+)
+
+# Images above this size are sent through the chunked upload_large API.
+LARGE_UPLOAD_THRESHOLD = 5 * 1024 * 1024
+LARGE_UPLOAD_CHUNK_SIZE = 6_000_000
+
+
+def _upload_sync(data, folder, public_id, deck_tag):
+    # upload_large defaults to resource_type="raw", so always ask for an image asset.
+    options = dict(folder=folder, public_id=public_id, tags=[deck_tag], overwrite=False, resource_type="image")
+    if len(data) > LARGE_UPLOAD_THRESHOLD:
+        result = cloudinary.uploader.upload_large(io.BytesIO(data), chunk_size=LARGE_UPLOAD_CHUNK_SIZE, **options)
+    else:
+        result = cloudinary.uploader.upload(io.BytesIO(data), **options)
+    # With overwrite=False an already stored asset is returned untouched, so the
+    # deck tag has to be added separately for it to show up in the archive.
+    # A tagging failure only affects the archive, so it must not turn a good
+    # upload into an error entry.
+    if result.get("existing"):
+        try:
+            cloudinary.uploader.add_tag(deck_tag, [result["public_id"]], resource_type="image")
+        except Exception as e:
+            print(f"Error tagging existing image {result['public_id']} with {deck_tag}: {e}")
+    return result
+
+
+async def _upload(data, folder, public_id, deck_tag):
+    # Wait for a slot before taking a thread, so queued uploads do not tie up
+    # the default executor that aiofiles also relies on.
+    async with _upload_slots:
+        return await asyncio.to_thread(_upload_sync, data, folder, public_id, deck_tag)
+
+
+# --- Spire Worker Pool ---
+# Spire keeps global .NET state and blocks on every interop call, so decks are
+# parsed in separate processes to keep the event loop free and let requests
+# run in parallel. Workers are spawned rather than forked from a process that
+# is already running the event loop and its threads.
+def _new_process_pool():
+    return ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+
+
+PROCESS_POOL = _new_process_pool()
+
+
+async def _run_process(*args):
+    global PROCESS_POOL
+    pool = PROCESS_POOL
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, _process, *args)
+    except BrokenProcessPool:
+        # A worker died (e.g. a native Spire crash on a malformed deck). Fail
+        # this request but replace the pool so later requests still work.
+        if PROCESS_POOL is pool:
+            PROCESS_POOL = _new_process_pool()
+            pool.shutdown(wait=False)
+        raise
+
+
+# --- Result Cache ---
+# Extraction results are memoized on disk by deck content and flags, so a
+# re-submitted deck skips the Spire parse and the Cloudinary uploads entirely.
+# Entries expire after CACHE_TTL_SECONDS and only the newest CACHE_MAX_ENTRIES
+# are kept. The helpers do blocking file I/O, so call them via asyncio.to_thread.
+CACHE_DIR = os.path.join(tempfile.gettempdir(), "pptx_cache")
+CACHE_TTL_SECONDS = 3600
+CACHE_MAX_ENTRIES = 64
+os.makedirs(CACHE_DIR, exist_ok=True)
+
+
+def _load_cached(key):
+    cache_path = os.path.join(CACHE_DIR, f"{key}.json")
+    try:
+        if time.time() - os.path.getmtime(cache_path) > CACHE_TTL_SECONDS:
+            os.remove(cache_path)
+            return None
+        with open(cache_path, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+
+def _prune_cache():
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+        # Skip files another request is still writing.
+        if not entry.name.endswith(".json"):
+            continue
+        try:
+            entries.append((entry.stat().st_mtime, entry.path))
+        except OSError:
+            continue
+    entries.sort(reverse=True)
+    now = time.time()
+    for index, (mtime, path) in enumerate(entries):
+        if index >= CACHE_MAX_ENTRIES or now - mtime > CACHE_TTL_SECONDS:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def _store_cached(key, presentation_data):
+    # Write to a sibling file first so a concurrent reader never sees a partial entry.
+    try:
+        fd, partial_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".partial")
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(presentation_data))
+        os.replace(partial_path, os.path.join(CACHE_DIR, f"{key}.json"))
+        _prune_cache()
+    except OSError as e:
+        print(f"Error writing extraction cache entry {key}: {e}")
+
+
+def _read_image(image, scratch_path):
+    # Spire can only save to a path, so every image of a request goes through
+    # the same scratch file and is uploaded from memory.
+    image.Save(scratch_path)
+    with open(scratch_path, "rb") as f:
+        return f.read()
+
+
+# Charts are rendered at screen resolution rather than Spire's high-DPI
+# default, capped in size and re-encoded as WebP to keep the payload small.
+CHART_DPI = 96
+CHART_MAX_DIMENSION = 1600
+CHART_WEBP_QUALITY = 85
+
+
+def _encode_chart(data):
+    with Image.open(io.BytesIO(data)) as chart:
+        chart.thumbnail((CHART_MAX_DIMENSION, CHART_MAX_DIMENSION))
+        buffer = io.BytesIO()
+        chart.save(buffer, "WEBP", quality=CHART_WEBP_QUALITY, method=4)
+    return buffer.getvalue()
+
+
+def _render_chart(shapes, shape_index, shape, scratch_path):
+    return _encode_chart(_read_image(shapes.SaveAsImage(shape_index, CHART_DPI, CHART_DPI), scratch_path))
+
+
+def _render_picture(shapes, shape_index, shape, scratch_path):
+    # Slide pictures hold their image under PictureFill.Picture.EmbedImage; each
+    # step is a .NET proxy that may be None.
+    picture_fill = shape.PictureFill
+    picture = picture_fill.Picture if picture_fill is not None else None
+    embed_image = picture.EmbedImage if picture is not None else None
+    image = embed_image.Image if embed_image is not None else None
+    if image is None:
+        return None
+    return _read_image(image, scratch_path)
+
+
+# Shape classes that yield an image, mapped to the function that renders them.
+# Picture shapes on a slide come back from Spire as SlidePicture; PictureShape
+# is only the object behind SlidePicture.PictureFill.Picture.
+IMAGE_HANDLERS = ((IChart, _render_chart), (SlidePicture, _render_picture))
+
+
+@functools.lru_cache(maxsize=None)
+def _image_handler_for(shape_type):
+    # Resolved once per concrete proxy class; the issubclass checks walk the
+    # .NET proxy MRO, so they should not run for every shape.
+    for handled_type, handler in IMAGE_HANDLERS:
+        if issubclass(shape_type, handled_type):
+            return handler
+    return None
+
+
+class InvalidPresentationError(Exception):
+    """Raised by _process when Spire cannot load the uploaded file as a presentation."""
+
+
+def _process(pptx_path, extractText, extractImage):
+    """Parse a deck with Spire in a worker process.
+
+    Returns the per-slide content and the extracted image bytes keyed by
+    digest. Successfully extracted images appear in a slide's "images" list as
+    ``(digest, shape_number)`` placeholders for the caller to resolve once the
+    uploads finish.
+
+    Only shapes placed on each slide are walked; images that live solely in
+    layouts or masters are never extracted or uploaded.
+    """
+    ppt = None
+    slides = []
+    image_data_by_digest = {}
+    scratch_image_path = None
+
+    try:
+        ppt = Presentation()
+        try:
+            ppt.LoadFromFile(pptx_path)
+        except Exception as e:
+            # Other ZIP/OLE formats (.docx, .xls, ...) pass the signature sniff and only fail here.
+            raise InvalidPresentationError(str(e)) from None
+
+        if extractImage:
+            scratch_fd, scratch_image_path = tempfile.mkstemp(suffix=".png")
+            os.close(scratch_fd)
+
+        for slide_index, slide in enumerate(ppt.Slides):
+            slide_content = { "slide": slide_index + 1 }
+
+            slide_text = []
+            if extractText:
+                slide_content["text"] = slide_text
+            if extractImage:
+                slide_content["images"] = []
+
+            # Every access to slide.Shapes crosses into .NET, so walk it once for both text and images.
+            shapes = slide.Shapes
+            for shape_index, shape in enumerate(shapes):
+                if extractText and isinstance(shape, IAutoShape):
+                    text_frame = shape.TextFrame
+                    if text_frame is not None:
+                        for paragraph in text_frame.Paragraphs:
+                            # paragraph.Text is a .NET property, so fetch it once.
+                            if (text := paragraph.Text) and text.strip():
+                                slide_text.append(text)
+
+                if not extractImage:
+                    continue
+
+                shape_number = shape_index + 1
+                try:
+                    image_handler = _image_handler_for(type(shape))
+                    image_data = (
+                        image_handler(shapes, shape_index, shape, scratch_image_path) if image_handler is not None else None
+                    )
+
+                    if image_data is not None:
+                        # Identical images (logos, backgrounds) are uploaded only once per deck.
+                        digest = hashlib.blake2b(image_data, digest_size=16).hexdigest()
+                        if digest not in image_data_by_digest:
+                            image_data_by_digest[digest] = (image_data, slide_index + 1)
+                        slide_content["images"].append((digest, shape_number))
+
+                except Exception as e:
+                    print(f"Error processing image from slide {slide_index + 1}, shape {shape_number}: {e}")
+                    slide_content["images"].append({"error": f"Failed to extract/upload image for shape {shape_number}"})
+
+            # Empty layout/placeholder slides only add bytes to the response.
+            if slide_content.get("text") or slide_content.get("images"):
+                slides.append(slide_content)
+
+        return slides, image_data_by_digest
+
+    finally:
+        if ppt is not None:
+            ppt.Dispose()
+        if scratch_image_path and os.path.exists(scratch_image_path):
+            os.remove(scratch_image_path)
+
+
+async def _stream_slides(slides, upload_tasks, cache_key, archive_url):
+    """Yield the ``{"slides": [...], "archive": ...}`` body one slide at a time.
+
+    Each slide is emitted as soon as its own uploads have finished, so the
+    client can start consuming results while later slides are still uploading.
+    The archive URL is only included when at least one image was uploaded.
+    """
+    has_errors = False
+    has_uploads = False
+    try:
+        yield b'{"slides":['
+        for slide_index, slide_content in enumerate(slides):
+            images = slide_content.get("images", [])
+            for index, image in enumerate(images):
+                if isinstance(image, dict):
+                    has_errors = True
+                    continue
+                digest, shape_number = image
+                try:
+                    upload_result = await upload_tasks[digest]
+                except Exception as e:
+                    print(f"Error uploading image from slide {slide_content['slide']}, shape {shape_number}: {e}")
+                    images[index] = {"error": f"Failed to extract/upload image for shape {shape_number}"}
+                    has_errors = True
+                else:
+                    images[index] = upload_result['secure_url']
+                    has_uploads = True
+                    print(f"Uploaded image from slide {slide_content['slide']}, shape {shape_number} to Cloudinary.")
+            yield (b"," if slide_index else b"") + orjson.dumps(slide_content)
+        if has_uploads:
+            yield b'],"archive":' + orjson.dumps(archive_url) + b"}"
+        else:
+            yield b"]}"
+
+        # Failed uploads are not cached so that a retry gets another chance. The
+        # signed archive URL expires, so it is left out and rebuilt on each hit.
+        if not has_errors:
+            await asyncio.to_thread(_store_cached, cache_key, {"slides": slides})
+    finally:
+        # If the client went away mid-stream, stop the uploads nobody will read
+        # and retrieve the outcome of finished ones so their errors are not lost.
+        for task in upload_tasks.values():
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()
+
+
+def _upload_too_large():
+    return HTTPException(
+        status_code=413,
+        detail=f"File too large. The maximum upload size is {MAX_UPLOAD_BYTES} bytes."
+    )
+
 
 app = FastAPI(
     title="PowerPoint Extractor API",
     description="API to extract text and images from PPTX files using Spire.Presentation and Cloudinary.",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    # Runs before the route parses the multipart form, so oversized requests are
+    # rejected without their body ever being read. Chunked requests carry no
+    # Content-Length and are limited while the upload is copied instead.
+    content_length = request.headers.get("content-length")
+    if content_length is not None:
+        try:
+            content_length = int(content_length)
+        except ValueError:
+            return ORJSONResponse(status_code=400, content={"detail": "Invalid Content-Length header."})
+        if content_length > MAX_UPLOAD_BYTES:
+            error = _upload_too_large()
+            return ORJSONResponse(status_code=error.status_code, content={"detail": error.detail})
+    return await call_next(request)
+
 @app.post("/extract-pptx")
 async def extract_pptx(
     File: UploadFile = File(..., description="The PowerPoint presentation file (.pptx)"),
@@ -41,7 +396,10 @@ async def extract_pptx(
     extractImage: bool = Form(False, description="Set to true to extract images (charts, pictures) and upload to Cloudinary."),
     extractAll: bool = Form(False, description="Set to true to extract both text and images. This flag overrides `extractText` and `extractImage` if set to true.")
 ):
-    if not File.filename.endswith(('.pptx', '.ppt')):
+    # Sniff the container signature instead of trusting the file extension.
+    file_signature = await File.read(4)
+    await File.seek(0)
+    if file_signature not in PRESENTATION_SIGNATURES:
         raise HTTPException(
             status_code=400,
             detail="Invalid file type. Only .pptx or .ppt files are accepted."
@@ -57,80 +415,76 @@ async def extract_pptx(
             detail="At least one extraction option (extractText, extractImage, or extractAll) must be true."
         )
 
-    ppt = None
-    presentation_data = {"slides": []}
+    # Fail before parsing the deck rather than letting every upload fail afterwards.
+    if extractImage and not CLOUDINARY_CONFIGURED:
+        raise HTTPException(
+            status_code=503,
+            detail="Image extraction is unavailable because Cloudinary credentials are not configured."
+        )
+
     temp_pptx_path = None
 
     try:
-        ppt = Presentation()
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pptx") as temp_file:
-            contents = await File.read()
-            temp_file.write(contents)
+        file_hash = hashlib.sha1()
+        received_bytes = 0
+        async with aiofiles.tempfile.NamedTemporaryFile("wb", delete=False, suffix=".pptx") as temp_file:
             temp_pptx_path = temp_file.name
+            # Stream in 1MB chunks so peak memory does not grow with the deck size,
+            # without blocking the event loop on disk writes.
+            while chunk := await File.read(1024 * 1024):
+                # Content-Length is absent on chunked requests, so enforce the limit here too.
+                received_bytes += len(chunk)
+                if received_bytes > MAX_UPLOAD_BYTES:
+                    raise _upload_too_large()
+                file_hash.update(chunk)
+                await temp_file.write(chunk)
 
-        ppt.LoadFromFile(temp_pptx_path)
+        # The uploaded URLs contain a folder derived from the file name, so the
+        # name is part of the cache key along with the content and flags.
+        base_name = os.path.basename(File.filename).rsplit('.', 1)[0]
+        deck_tag = f"pptx_{file_hash.hexdigest()}"
+        cache_key = hashlib.sha1(
+            f"{file_hash.hexdigest()}|{base_name}|{extractText}|{extractImage}".encode()
+        ).hexdigest()
+        cached_data = await asyncio.to_thread(_load_cached, cache_key)
+        if cached_data is not None:
+            # Cached entries contain no failed uploads, so any image means the deck has an archive.
+            if any(slide.get("images") for slide in cached_data["slides"]):
+                cached_data["archive"] = cloudinary.utils.download_archive_url(tags=[deck_tag])
+            return ORJSONResponse(content=cached_data)
 
-        for slide_index, slide in enumerate(ppt.Slides):
-            slide_content = { "slide": slide_index + 1 }
+        slides, image_data_by_digest = await _run_process(temp_pptx_path, extractText, extractImage)
 
-            if extractText:
-                slide_content["text"] = []
-                for shape in slide.Shapes:
-                    if isinstance(shape, IAutoShape) and shape.TextFrame is not None:
-                        for paragraph in shape.TextFrame.Paragraphs:
-                            if paragraph.Text.strip():
-                                slide_content["text"].append(paragraph.Text)
+        # --- Upload all extracted images concurrently ---
+        folder_prefix = f"pptx_extractions/{base_name}"
+        upload_tasks = {
+            digest: asyncio.ensure_future(
+                _upload(image_data, f"{folder_prefix}/slide_{slide_number}", digest, deck_tag)
+            )
+            for digest, (image_data, slide_number) in image_data_by_digest.items()
+        }
 
-            if extractImage:
-                slide_content["images"] = []
-                image_count_on_slide = 1
-
-                for shape in slide.Shapes:
-                    temp_image_file = None
-                    try:
-                        image_to_save = None
-                        
-                        if isinstance(shape, IChart):
-                            image_to_save = shape.SaveAsImage()
-
-                        # --- FIX 1: Use the correct class name 'PictureShape' ---
-                        elif isinstance(shape, PictureShape):
-                            # --- FIX 2: Use 'is not None' to avoid the bug ---
-                            if shape.Picture is not None and shape.Picture.Image is not None:
-                                image_to_save = shape.Picture.Image
-                        
-                        if image_to_save is not None:
-                            with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tf:
-                                temp_image_file = tf.name
-                            image_to_save.Save(temp_image_file)
-                        
-                            upload_result = cloudinary.uploader.upload(temp_image_file, 
-                                folder=f"pptx_extractions/{os.path.basename(File.filename).split('.')[0]}/slide_{slide_index + 1}")
-                            slide_content["images"].append(upload_result['secure_url'])
-                            print(f"Uploaded image from slide {slide_index + 1}, shape {image_count_on_slide} to Cloudinary.")
-                        
-                    except Exception as e:
-                        print(f"Error processing image from slide {slide_index + 1}, shape {image_count_on_slide}: {e}")
-                        if "images" not in slide_content:
-                            slide_content["images"] = []
-                        slide_content["images"].append({"error": f"Failed to extract/upload image for shape {image_count_on_slide}"})
-                    finally:
-                        if temp_image_file and os.path.exists(temp_image_file):
-                            os.remove(temp_image_file)
-                    image_count_on_slide += 1
-            
-            presentation_data["slides"].append(slide_content)
-
-        return JSONResponse(content=presentation_data)
+        # Every image of the deck is tagged with deck_tag, so the whole set can be
+        # downloaded as one ZIP from this URL.
+        archive_url = cloudinary.utils.download_archive_url(tags=[deck_tag]) if upload_tasks else None
+
+        return StreamingResponse(
+            _stream_slides(slides, upload_tasks, cache_key, archive_url), media_type="application/json"
+        )
 
+    except HTTPException:
+        raise
+    except InvalidPresentationError as e:
+        print(f"Rejected upload that Spire could not load: {e}")
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid file. The upload is not a valid .pptx or .ppt presentation."
+        )
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"An error occurred during PPTX processing: {e}"
         )
     finally:
-        if ppt is not None:
-            ppt.Dispose()
         if temp_pptx_path and os.path.exists(temp_pptx_path):
             os.remove(temp_pptx_path)
\ No newline at end of file